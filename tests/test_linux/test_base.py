@@ -1,8 +1,34 @@
+import ctypes
+import mmap
+import os
+import subprocess
+import sys
 import unittest
+from typing import Any, Tuple
+from unittest import mock
 from zipfile import ZipFile
 
 from varc_core.systems import BaseSystem, acquire_system
 
+# Maps 9 pages in a child process: 2 pages of 0x61, then 3 pages of a one page file mapped shared
+# (the last 2 fault as they're past the end of the file), then 4 pages of 0x42
+_FAULTING_CHILD = """
+import ctypes, mmap, sys, tempfile
+libc = ctypes.CDLL("libc.so.6", use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+page = mmap.PAGESIZE
+base = libc.mmap(None, 9 * page, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS, -1, 0)
+ctypes.memset(base, 0x61, 2 * page)
+ctypes.memset(base + 5 * page, 0x42, 4 * page)
+backing = tempfile.TemporaryFile()
+backing.write(b"A" * page)
+backing.flush()
+libc.mmap(base + 2 * page, 3 * page, mmap.PROT_READ, mmap.MAP_SHARED | 0x10, backing.fileno(), 0) # 0x10 is MAP_FIXED
+print(base, flush=True)
+sys.stdin.read()
+"""
+
 class TestBaseCases(unittest.TestCase):
     system: BaseSystem
     zip_path: str
@@ -17,11 +43,66 @@ class TestBaseCases(unittest.TestCase):
     def tearDownClass(cls) -> None:
         pass
 
+    def start_faulting_child(self) -> Tuple[int, int]:
+        """Starts _FAULTING_CHILD, returning its pid and the address of its first page"""
+        child = subprocess.Popen([sys.executable, "-c", _FAULTING_CHILD], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(child.wait)
+        self.addCleanup(child.stdin.close) # type: ignore
+        base = int(child.stdout.readline()) # type: ignore
+        child.stdout.close() # type: ignore
+        return child.pid, base
+
+    def test_faulting_region_does_not_lose_later_regions(self) -> None:
+        pid, base = self.start_faulting_child()
+        page = mmap.PAGESIZE
+        maps = self.system.parse_mem_map(pid, "python3") # type: ignore
+        self.assertIn((base + 2 * page, base + 5 * page), maps)
+        regions = [region for region in maps if base <= region[0] < base + 9 * page]
+        dump = b"".join(self.system.read_regions(pid, regions, self.system._read_buf)) # type: ignore
+        self.assertIn(b"\x61" * 2 * page, dump)
+        self.assertIn(b"\x42" * 4 * page, dump)
+
+    def test_read_regions_matches_read_bytes(self) -> None:
+        pid, base = self.start_faulting_child()
+        page = mmap.PAGESIZE
+        # An unmapped region, then the readable, faulting and readable regions
+        regions = [(page, 2 * page), (base, base + 2 * page), (base + 2 * page, base + 5 * page), (base + 5 * page, base + 9 * page)]
+        # A 2 page buffer splits regions across several process_vm_readv calls
+        dump = b"".join(self.system.read_regions(pid, regions, ctypes.create_string_buffer(2 * page))) # type: ignore
+        expected = b"".join(self.system.read_bytes(pid, start, end - start) or b"" for start, end in regions) # type: ignore
+        self.assertEqual(len(dump), 9 * page)
+        self.assertEqual(dump, expected)
+
     def test_some_processes(self) -> None:
         processes = self.system.get_processes()
         self.assertTrue(len(processes) > 0)
         process_names = [process["Name"] for process in processes]
         self.assertIn("python3", process_names)
+
+    def test_processes_dict_from_proc(self) -> None:
+        processes = {process["pid"]: process for process in self.system.get_processes_dict()}
+        self.assertIn(os.getpid(), processes)
+        process = processes[os.getpid()]
+        self.assertEqual(process["ppid"], os.getppid())
+        self.assertEqual(process["status"], "running")
+        self.assertTrue(process["cmdline"])
+
+    def test_processes_dict_skips_unreadable_process(self) -> None:
+        real_open = open
+        unreadable = f"/proc/{os.getpid()}/"
+
+        def deny_open(file: Any, *args: Any, **kwargs: Any) -> Any:
+            if str(file).startswith(unreadable):
+                raise PermissionError(13, "Permission denied", file)
+            return real_open(file, *args, **kwargs)
+
+        with mock.patch("builtins.open", side_effect=deny_open):
+            with self.assertRaises(PermissionError):
+                self.system.read_proc(os.getpid(), 0, 100, {}) # type: ignore
+            processes = self.system.get_processes_dict()
+        pids = [process["pid"] for process in processes]
+        self.assertNotIn(os.getpid(), pids)
+        self.assertIn(os.getppid(), pids)
         
         
     def test_dump_files(self) -> None:
@@ -14,7 +14,9 @@ import os
 import os.path
 import json
 import zipfile
-from typing import List
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, List, Set, Tuple
 from datetime import datetime
 import logging
 from typing import Optional
@@ -23,8 +25,23 @@ import time
 
 from varc_core.utils.string_manips import remove_special_characters, strip_drive
 
+try:
+    import orjson # Optional, much faster than json for large process tables
+except ImportError:
+    orjson = None # type: ignore
+
 
 _MAX_OPEN_FILE_SIZE = 10000000 # 10 Mb max dumped filesize
+_OPEN_FILE_WORKERS = 4 # Threads reading open files ahead of them being written to the archive
+# Only the process fields that are used, so psutil doesn't collect the rest.
+# Fields the platform doesn't support are left out, e.g. memory_maps on OSX, as psutil rejects them
+_PROCESS_ATTRS = [
+    attr for attr in [
+        "pid", "name", "ppid", "cmdline", "exe", "status", "username",
+        "create_time", "open_files", "memory_maps", "connections"
+    ]
+    if attr == "pid" or hasattr(psutil.Process, attr)
+]
 
 
 class BaseSystem:
@@ -47,13 +64,17 @@ class BaseSystem:
         extract_dumps: bool = False,
     ) -> None:
         self.todays_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        logging.info(f'Acquiring system: {self.get_machine_name()}, at {self.todays_date}')
+        self.machine_name = self.get_machine_name()
+        logging.info(f'Acquiring system: {self.machine_name}, at {self.todays_date}')
         self.timestamp = datetime.timestamp(datetime.now())
         self.process_name = process_name
         self.process_id = process_id
         self.extract_dumps = extract_dumps
         self.include_memory = include_memory
         self.include_open = include_open
+        self.include_screenshot = take_screenshot
+        self._proc_cache: Dict[int, dict] = {}
+        self._net_connections: Optional[list] = None
     
         if self.process_name and self.process_id:
             raise ValueError("Only one of Process name or Process ID (PID) can be used. Please re-run using one or the other.")
@@ -66,72 +87,97 @@ class BaseSystem:
         :rtype List[string]
         """
         network = []
-        try:
-            connections = psutil.net_connections()
-        except psutil.AccessDenied:
-            logging.error("Access denied attempting to get network connections") # without sudo on osx
-            connections = []
+        connections = self.get_net_connections()
+        process_names = {pid: process["name"] for pid, process in self._proc_cache.items()}
+        if any(conn.pid is not None and conn.pid not in process_names for conn in connections):
+            # Some processes weren't collected, so look up every name in a single pass
+            for proc in psutil.process_iter(attrs=["pid", "name"]):
+                process_names.setdefault(proc.info["pid"], proc.info["name"])
+        syslog_date: str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         for conn in connections:
             if conn.laddr and conn.raddr:
-                syslog_date: str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                process_name: str = psutil.Process(conn.pid).name()
+                process_name = process_names.get(conn.pid, "")
                 log_line = f"{syslog_date} {conn.laddr.ip} {conn.laddr.port} {conn.raddr.ip} {conn.raddr.port} {process_name}"
                 network.append(log_line)
         return network
 
+    def get_net_connections(self) -> list:
+        """Get system wide network connections, collected once per acquisition as walking them is slow
+
+        :return: List of psutil connections
+        """
+        if self._net_connections is None:
+            try:
+                self._net_connections = psutil.net_connections()
+            except psutil.AccessDenied:
+                logging.error("Access denied attempting to get network connections") # without sudo on osx
+                self._net_connections = []
+        return self._net_connections
+
     def get_processes_dict(self) -> List[dict]:
         """Get processes on system, potentially filtered
 
         :return: List of processes as dicts
         """
         if self.process_id:
-            return [psutil.Process(self.process_id).as_dict()]
+            processes = [psutil.Process(self.process_id).as_dict(attrs=_PROCESS_ATTRS)]
         elif self.process_name:
-            process_choice = []
-            for proc in psutil.process_iter():
-                proc_dict = proc.as_dict()
-                if proc_dict["name"].lower() == self.process_name.lower():
-                    process_choice.append(proc_dict)
-            return process_choice
+            processes = []
+            for proc in psutil.process_iter(attrs=_PROCESS_ATTRS):
+                if proc.info["name"].lower() == self.process_name.lower():
+                    processes.append(proc.info)
         else:
-            return [proc.as_dict() for proc in psutil.process_iter()]
+            processes = [proc.info for proc in psutil.process_iter(attrs=_PROCESS_ATTRS)]
+        self._proc_cache = {process["pid"]: process for process in processes}
+        return processes
 
-    def dump_loaded_files(self) -> List[str]:
+    def dump_loaded_files(self, process_choice: Optional[List[dict]] = None) -> List[Tuple[str, int]]:
         """Collects files that are open
 
-        :return: List of filepaths that were collected
+        :param process_choice: Processes from get_processes_dict, collected again if not given
+        :return: List of (filepath, file size) tuples that were collected
         """
 
-        process_choice = self.get_processes_dict()
+        if process_choice is None:
+            process_choice = self.get_processes_dict()
 
-        open_files: List[str] = []
-        mapped_filepaths: List[str] = []
-        exe_paths: List[str] = []
+        # Shared libraries are mapped by most processes, so dedupe as paths are collected
+        paths: Set[str] = set()
 
         for process in process_choice:
             proc_open_files = process.get("open_files", [])
             if proc_open_files:
-                open_files += [open_file.path for open_file in proc_open_files]
+                paths.update(open_file.path for open_file in proc_open_files)
             proc_memory_maps = process.get("memory_maps", []) 
             if proc_memory_maps:
-                mapped_filepaths += [path.path for path in proc_memory_maps]
+                paths.update(path.path for path in proc_memory_maps)
             proc_exe = process.get("exe", [])
             if proc_exe:
-                exe_paths += proc_exe
-
-        # Combine and unique
-        paths = list(set(open_files + mapped_filepaths + exe_paths))
-        # only return paths that exist
-        return [path for path in paths if (len(path) > 1 and os.path.exists(path) and os.path.getsize(path))]
-
-    def get_processes(self) -> List[dict]:
+                paths.add(proc_exe)
+
+        # only return paths that exist, with one stat per path
+        loaded_files: List[Tuple[str, int]] = []
+        for path in paths:
+            if len(path) <= 1:
+                continue
+            try:
+                file_size = os.stat(path).st_size
+            except OSError:
+                continue
+            if file_size:
+                loaded_files.append((path, file_size))
+        return loaded_files
+
+    def get_processes(self, process_choice: Optional[List[dict]] = None) -> List[dict]:
         """Get running process(es) 
 
+        :param process_choice: Processes from get_processes_dict, collected again if not given
         :return: List of running processes - e.g. [{'pid': 1}]
         """
         process_data: List[dict] = []
 
-        process_choice = self.get_processes_dict()
+        if process_choice is None:
+            process_choice = self.get_processes_dict()
 
         for process in process_choice:
             creation_time = datetime.utcfromtimestamp(process["create_time"]).strftime('%Y-%m-%d %H:%M:%S')
@@ -168,15 +214,21 @@ class BaseSystem:
                                 })
         return process_data
 
-    def dict_to_json(self, rows: List[dict]) -> str:
+    def dict_to_json(self, rows: List[dict]) -> bytes:
         """Takes a list of rows/dict and returns as a json with a CadoJsonTable header
 
         :param rows: The List[Dict] of row data e.g. [{'filepath': 'file.txt'}]
 
-        :return: The Json string
+        :return: The UTF-8 encoded Json
         """
         table_dict = {"format": "CadoJsonTable", "rows": rows}
-        return json.dumps(table_dict, sort_keys=False, indent=1)
+        if orjson:
+            try:
+                return orjson.dumps(table_dict, option=orjson.OPT_INDENT_2)
+            except TypeError:
+                # orjson.JSONEncodeError, e.g. undecodable characters in a command line, fall back to json
+                pass
+        return json.dumps(table_dict, sort_keys=False, indent=1).encode()
 
     def get_machine_name(self) -> str:
         """Return machine name without any special characters removed
@@ -200,50 +252,86 @@ class BaseSystem:
             logging.error("Unable to take screenshot")
         return None
 
+    def read_open_file(self, file_path: str) -> Tuple[zipfile.ZipInfo, bytes]:
+        """Reads an open file ready to be added to the archive, called from worker threads
+
+        :param file_path: Path of the file to read
+        :return: The ZipInfo for the file and its contents
+        """
+        zip_info = zipfile.ZipInfo.from_file(file_path, strip_drive(file_path))
+        with open(file_path, "rb") as src_file:
+            # Files can grow after they were sized, so read one byte past the limit to tell if they did
+            return zip_info, src_file.read(_MAX_OPEN_FILE_SIZE + 1)
+
+    def write_open_file(self, zip_file: zipfile.ZipFile, file_path: str, read_future: Future) -> None:
+        """Adds an open file read by read_open_file to the archive
+
+        :param zip_file: The archive to add the file to
+        :param file_path: Path of the file
+        :param read_future: Future of the read_open_file call for the file
+        """
+        logging.info(f"Adding open file {file_path}")
+        try:
+            zip_info, file_content = read_future.result()
+            if len(file_content) > _MAX_OPEN_FILE_SIZE:
+                logging.warning(f"Skipping file as too large {file_path}")
+                return
+            zip_info.compress_type = zip_file.compression
+            zip_file.writestr(zip_info, file_content)
+        except PermissionError:
+            logging.warn(f"Permission denied copying {file_path}")
+        except FileNotFoundError:
+            logging.warning(f"Could not open {file_path} for reading")
+
     def acquire_volatile(self, output_path: Optional[str] = None) -> str:
         """Acquire volatile data into a zip file
         This is called by all OS's
 
         :return: The filepath of the zip
         """
-        self.process_info = self.get_processes()
-        self.network_log = self.get_network()
-        self.dumped_files = self.dump_loaded_files() if self.include_open else []
-        table_data = {}
-        table_data["processes"] = self.dict_to_json(self.process_info)
-        open_files_dict = [{"Open File": open_file} for open_file in self.dumped_files]
-        table_data["open_files"] = self.dict_to_json(open_files_dict)
-        if self.take_screenshot:
-            screenshot = self.take_screenshot()
-        else:
-            screenshot = None
+        self._net_connections = None # Collect fresh connections for this acquisition
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Encode the screenshot in the background while processes are collected
+            screenshot_future: Optional[Future] = None
+            if self.include_screenshot:
+                screenshot_future = executor.submit(self.take_screenshot)
+            # Only walk the processes once, get_network uses the same processes through the pid cache
+            processes = self.get_processes_dict()
+            self.process_info = self.get_processes(processes)
+            self.network_log = self.get_network()
+            self.dumped_files = self.dump_loaded_files(processes) if self.include_open else []
+            table_data = {}
+            table_data["processes"] = self.dict_to_json(self.process_info)
+            open_files_dict = [{"Open File": open_file} for open_file, _ in self.dumped_files]
+            table_data["open_files"] = self.dict_to_json(open_files_dict)
+            screenshot = screenshot_future.result() if screenshot_future else None
         if not output_path:
-            output_path = os.path.join("", f"{self.get_machine_name()}-{self.timestamp}.zip")
+            output_path = os.path.join("", f"{self.machine_name}-{self.timestamp}.zip")
         # strip .zip if in filename as shutil appends to end
         archive_out =  output_path + ".zip" if not output_path.endswith(".zip") else output_path
         self.output_path = output_path
         with zipfile.ZipFile(archive_out, 'a', compression=zipfile.ZIP_DEFLATED) as zip_file:
             if screenshot:
-                zip_file.writestr(f"{self.get_machine_name()}-{self.timestamp}.png", screenshot) 
+                # PNGs are already compressed
+                zip_file.writestr(f"{self.machine_name}-{self.timestamp}.png", screenshot, compress_type=zipfile.ZIP_STORED)
             for key, value in table_data.items():
-                with zip_file.open(f"{key}.json", 'w') as json_file:
-                    json_file.write(value.encode())
+                zip_file.writestr(f"{key}.json", value)
             if self.network_log:
                 logging.info("Adding Netstat Data")
                 with zip_file.open("netstat.log", 'w') as network_file:
                     network_file.write("\r\n".join(self.network_log).encode())
-            if self.dump_loaded_files:
-                for file_path in self.dumped_files:
-                    logging.info(f"Adding open file {file_path}")
-                    try:
-                        if os.path.getsize(file_path) > _MAX_OPEN_FILE_SIZE:
+            if self.include_open:
+                with ThreadPoolExecutor(max_workers=_OPEN_FILE_WORKERS) as executor:
+                    # Read files ahead on worker threads while this thread compresses and writes them
+                    pending: Deque[Tuple[str, Future]] = deque()
+                    for file_path, file_size in self.dumped_files:
+                        if file_size > _MAX_OPEN_FILE_SIZE:
                             logging.warning(f"Skipping file as too large {file_path}")
-                        else:
-                            try:
-                                zip_file.write(file_path, strip_drive(file_path))
-                            except PermissionError:
-                                logging.warn(f"Permission denied copying {file_path}")
-                    except FileNotFoundError:
-                        logging.warning(f"Could not open {file_path} for reading")
+                            continue
+                        pending.append((file_path, executor.submit(self.read_open_file, file_path)))
+                        if len(pending) >= _OPEN_FILE_WORKERS * 2:
+                            self.write_open_file(zip_file, *pending.popleft())
+                    while pending:
+                        self.write_open_file(zip_file, *pending.popleft())
 
         return archive_out
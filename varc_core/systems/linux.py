@@ -1,12 +1,18 @@
-from typing import List, Tuple, Any, Optional
+from typing import List, Tuple, Any, Optional, Iterator, Dict, NamedTuple, Union
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+import queue
+import threading
 import zipfile
-from tempfile import NamedTemporaryFile
+import os
+import pwd
+import stat
+import psutil
 from tqdm import tqdm
 import logging
-import re
 import ctypes
-from os import sep
+import errno
+from os import sep, strerror
 from varc_core.systems.base_system import BaseSystem
 
 # based on https://stackoverflow.com/questions/48897687/why-does-the-syscall-process-vm-readv-sets-errno-to-success and PymemLinux library
@@ -17,6 +23,52 @@ class IOVec(ctypes.Structure):
         ("iov_len", ctypes.c_size_t)
     ]
 
+
+def get_iov_max() -> int:
+    """Returns the maximum number of iovecs the kernel accepts per process_vm_readv call
+
+    :return: IOV_MAX from sysconf, or Linux's 1024 if it isn't available
+    """
+    try:
+        iov_max = os.sysconf("SC_IOV_MAX")
+    except (ValueError, OSError):
+        iov_max = -1
+    return iov_max if iov_max > 0 else 1024
+
+
+_IOV_MAX = get_iov_max()
+_READ_CHUNK_SIZE = 16 * 1024 * 1024 # 16 Mb local buffer filled by each process_vm_readv call
+_DUMP_WORKERS = min(8, os.cpu_count() or 1) # Processes read in parallel, each with its own buffer
+# Kernel provided mappings that can't be read with process_vm_readv
+_SKIPPED_MAPPINGS = {b"[vvar]", b"[vvar_vclock]", b"[vsyscall]"}
+
+
+# Same strings psutil uses for each /proc/<pid>/stat state
+_PROC_STATUSES = {
+    b"R": "running",
+    b"S": "sleeping",
+    b"D": "disk-sleep",
+    b"T": "stopped",
+    b"t": "tracing-stop",
+    b"Z": "zombie",
+    b"X": "dead",
+    b"x": "dead",
+    b"K": "wake-kill",
+    b"W": "waking",
+    b"I": "idle",
+    b"P": "parked",
+}
+
+
+class OpenFile(NamedTuple):
+    path: str
+    fd: int
+
+
+class MemoryMap(NamedTuple):
+    path: str
+
+
 class LinuxSystem(BaseSystem):
     
     def __init__(
@@ -27,7 +79,7 @@ class LinuxSystem(BaseSystem):
         **kwargs: Any
     ) -> None:
         super().__init__(include_memory=include_memory, include_open=include_open, extract_dumps=extract_dumps, **kwargs)
-        self.libc = ctypes.CDLL("libc.so.6")
+        self.libc = ctypes.CDLL("libc.so.6", use_errno=True)
         self.process_vm_readv = self.libc.process_vm_readv
         self.process_vm_readv.args = [ # type: ignore
             ctypes.c_int, 
@@ -38,28 +90,158 @@ class LinuxSystem(BaseSystem):
             ctypes.c_ulong
         ]
         self.process_vm_readv.restype = ctypes.c_ssize_t
+        self._read_buf = ctypes.create_string_buffer(_READ_CHUNK_SIZE)
         if self.include_memory:
             self.dump_processes()
             if self.extract_dumps:
                 from varc_core.utils import dumpfile_extraction
                 dumpfile_extraction.extract_dumps(Path(self.output_path))
 
+    def get_processes_dict(self) -> List[dict]:
+        """Get processes on system, potentially filtered
+        Reads only the fields that are used straight from /proc, which is much faster than psutil's as_dict
+
+        :return: List of processes as dicts
+        """
+        if self.process_id:
+            pids = [self.process_id]
+        else:
+            pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+
+        with open("/proc/stat", "rb") as proc_stat:
+            boot_time = next(int(line.split()[1]) for line in proc_stat if line.startswith(b"btime"))
+        clock_ticks = os.sysconf("SC_CLK_TCK")
+        connections_by_pid: Dict[int, list] = {}
+        for conn in self.get_net_connections():
+            connections_by_pid.setdefault(conn.pid, []).append(conn)
+        usernames: Dict[int, str] = {}
+
+        processes = []
+        for pid in pids:
+            try:
+                process = self.read_proc(pid, boot_time, clock_ticks, usernames)
+            except (FileNotFoundError, ProcessLookupError):
+                if self.process_id:
+                    raise psutil.NoSuchProcess(pid)
+                continue # Process exited while being read
+            except PermissionError:
+                # e.g. /proc mounted with hidepid, or an LSM denying access
+                logging.warning(f"Permission denied reading process details for pid {pid}. Skipping this process.")
+                continue
+            if self.process_name and process["name"].lower() != self.process_name.lower():
+                continue
+            process["connections"] = connections_by_pid.get(pid, [])
+            processes.append(process)
+        self._proc_cache = {process["pid"]: process for process in processes}
+        return processes
+
+    def read_proc(self, pid: int, boot_time: int, clock_ticks: int, usernames: Dict[int, str]) -> dict:
+        """Reads the details of process {pid} from /proc into the same shape as psutil's as_dict
+        Fields that can't be read due to permissions are None, as psutil does
+
+        :param pid: int of the process id
+        :param boot_time: int of the system boot time in seconds since the epoch
+        :param clock_ticks: int of clock ticks per second, that process start times are measured in
+        :param usernames: Dict of uid to username, shared between calls
+
+        :return: Dict of process details
+        :rtype: dict
+        """
+        proc_path = f"/proc/{pid}"
+        with open(f"{proc_path}/stat", "rb") as proc_stat:
+            stat_content = proc_stat.read()
+        # The name is in brackets and can itself contain spaces and brackets
+        name_end = stat_content.rindex(b")")
+        name = stat_content[stat_content.index(b"(") + 1:name_end].decode(errors="replace")
+        stat_fields = stat_content[name_end + 2:].split()
+
+        with open(f"{proc_path}/cmdline", "rb") as proc_cmdline:
+            cmdline = [arg.decode(errors="replace") for arg in proc_cmdline.read().split(b"\0")]
+        if cmdline and not cmdline[-1]:
+            cmdline.pop()
+        # Names are truncated to 15 characters, use the full name from the command line if it has one
+        if len(name) >= 15 and cmdline:
+            full_name = os.path.basename(cmdline[0])
+            if full_name.startswith(name):
+                name = full_name
+
+        uid = -1
+        with open(f"{proc_path}/status", "rb") as proc_status:
+            for line in proc_status:
+                if line.startswith(b"Uid:"):
+                    uid = int(line.split()[1])
+                    break
+        if uid not in usernames:
+            try:
+                usernames[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                usernames[uid] = str(uid)
+
+        try:
+            exe: Optional[str] = os.readlink(f"{proc_path}/exe")
+        except PermissionError:
+            exe = None
+        except FileNotFoundError:
+            exe = "" # Kernel threads have no executable
+
+        open_files: Optional[List[OpenFile]] = None
+        try:
+            fds = os.listdir(f"{proc_path}/fd")
+        except PermissionError:
+            fds = None
+        if fds is not None:
+            open_files = []
+            for fd in fds:
+                try:
+                    file_path = os.readlink(f"{proc_path}/fd/{fd}")
+                    if file_path.startswith("/") and stat.S_ISREG(os.stat(file_path).st_mode):
+                        open_files.append(OpenFile(file_path, int(fd)))
+                except OSError:
+                    continue
+
+        memory_maps: Optional[List[MemoryMap]] = []
+        try:
+            with open(f"{proc_path}/maps", "rb") as proc_maps:
+                maps_content = proc_maps.read()
+            mapped_paths = set()
+            for line in maps_content.splitlines():
+                map_fields = line.split(None, 5)
+                mapped_paths.add(map_fields[5].decode(errors="replace") if len(map_fields) > 5 else "[anon]")
+            memory_maps = [MemoryMap(path) for path in mapped_paths]
+        except PermissionError:
+            memory_maps = None
+
+        return {
+            "pid": pid,
+            "name": name,
+            "ppid": int(stat_fields[1]),
+            "status": _PROC_STATUSES.get(stat_fields[0], stat_fields[0].decode()),
+            "create_time": boot_time + int(stat_fields[19]) / clock_ticks,
+            "cmdline": cmdline,
+            "exe": exe,
+            "username": usernames[uid],
+            "open_files": open_files,
+            "memory_maps": memory_maps,
+        }
+
     def parse_mem_map(self, pid: int, p_name: str) -> List[Tuple[int, int]]:
         """Returns a list of (start address, end address) tuples of the regions of process memory that are mapped
         
         
         """
-        map_addresses = []
+        map_addresses: List[Tuple[int, int]] = []
         mem_map_path = Path(f"/proc/{pid}/maps")
         try:
-            with mem_map_path.open(mode="r") as mem_map:
-                map_content = mem_map.readlines()
-                for line in map_content:
-                    line_groups = re.match(r"([a-fA-F0-9]+)-([a-fA-F0-9]+)\s(r|-)" , line)
-                    if line_groups.group(3) == "r": # type: ignore # Only collecting pages that are readable
-                        page_start = int(line_groups.group(1), 16) # type: ignore
-                        page_end = int(line_groups.group(2), 16) # type: ignore
-                        map_addresses.append((page_start, page_end))
+            # Lines are fixed format ASCII, e.g. "7f2c4a000000-7f2c4a021000 rw-p 00000000 00:00 0   [heap]"
+            map_content = mem_map_path.read_bytes()
+            for line in map_content.splitlines():
+                addresses, perms, rest = line.split(b" ", 2)
+                if perms[0] != ord("r"): # Only collecting pages that are readable
+                    continue
+                if rest.endswith(b"]") and rest[rest.rindex(b" ") + 1:] in _SKIPPED_MAPPINGS:
+                    continue
+                page_start, page_end = addresses.split(b"-")
+                map_addresses.append((int(page_start, 16), int(page_end, 16)))
         except FileNotFoundError:
             logging.warning(f"Could not parse memory map for {p_name} (pid {pid}). Cannot dump this process.")
             return map_addresses
@@ -80,7 +262,8 @@ class LinuxSystem(BaseSystem):
         :rtype: bytes
         """
 
-        buff = ctypes.create_string_buffer(byte)
+        # Reuse the preallocated buffer rather than allocating and zeroing one per read
+        buff = self._read_buf if byte <= len(self._read_buf) else ctypes.create_string_buffer(byte)
         io_dst = IOVec(ctypes.cast(ctypes.byref(buff), ctypes.c_void_p), byte)
         io_src = IOVec(ctypes.c_void_p(address), byte)
 
@@ -88,34 +271,192 @@ class LinuxSystem(BaseSystem):
 
         if linux_syscall == -1:
             return None
+        if linux_syscall < byte:
+            # Zero the rest of a partial read, rather than returning a previous read's data
+            ctypes.memset(ctypes.addressof(buff) + linux_syscall, 0, byte - linux_syscall)
+
+        return ctypes.string_at(buff, byte)
+
+    def read_regions(self, pid: int, maps: List[Tuple[int, int]], buff: ctypes.Array) -> Iterator[bytes]:
+        """Reads the mapped regions {maps} of process {pid}, batching up to _IOV_MAX regions into each
+        process_vm_readv call, all read into the single preallocated buffer {buff}
+
+        :param pid: int of the process id
+        :param maps: List of (start address, end address) tuples to read
+        :param buff: ctypes buffer the regions are read into, reused for every call
+
+        :return: Iterator of the bytes read, in the same order as {maps}
+        :rtype: Iterator[bytes]
+        """
+        buff_size = len(buff)
+        buff_address = ctypes.addressof(buff)
+        buff_view = memoryview(buff).cast("B")
+        # Split regions larger than the buffer so every piece fits in a single call,
+        # keeping the (start, end) of the region each piece came from
+        regions = [
+            (address, min(buff_size, end - address), start, end)
+            for start, end in maps
+            for address in range(start, end, buff_size)
+        ]
+        index = 0
+        while index < len(regions):
+            batch: List[Tuple[int, int]] = []
+            batch_len = 0
+            for address, length, _, _ in regions[index:index + _IOV_MAX]:
+                if batch_len + length > buff_size:
+                    break
+                batch.append((address, length))
+                batch_len += length
+
+            count = len(batch)
+            io_dst = (IOVec * count)()
+            io_src = (IOVec * count)()
+            offset = 0
+            for i, (address, length) in enumerate(batch):
+                io_dst[i] = IOVec(buff_address + offset, length)
+                io_src[i] = IOVec(address, length)
+                offset += length
+
+            linux_syscall = self.process_vm_readv(pid, io_dst, count, io_src, count, 0)
+
+            if linux_syscall == batch_len:
+                yield buff_view[:batch_len].tobytes()
+                index += count
+                continue
+            if linux_syscall == -1:
+                err = ctypes.get_errno()
+                if err in (errno.EPERM, errno.ESRCH):
+                    raise OSError(err, strerror(err))
+            # Partial read, keep the pieces that were read then handle the region that faulted as read_bytes would:
+            # nothing if it faulted on its first byte, otherwise zero filled from the fault to its end
+            bytes_read = max(linux_syscall, 0)
+            completed = 0
+            completed_len = 0
+            while completed_len + batch[completed][1] <= bytes_read:
+                completed_len += batch[completed][1]
+                completed += 1
+            if bytes_read:
+                yield buff_view[:bytes_read].tobytes()
+            index += completed
+            fault_address = regions[index][0] + bytes_read - completed_len
+            region_start, region_end = regions[index][2:]
+            if fault_address > region_start:
+                for zero_start in range(fault_address, region_end, buff_size):
+                    yield bytes(min(buff_size, region_end - zero_start))
+            # Skip the rest of the faulting region
+            while index < len(regions) and regions[index][2] == region_start:
+                index += 1
 
-        return buff.raw
+    def queue_regions(
+        self,
+        pid: int,
+        p_name: str,
+        buffers: "queue.Queue[ctypes.Array]",
+        chunks: "queue.Queue[Union[bytes, Exception, None]]",
+        cancel: threading.Event
+    ) -> None:
+        """Reads the memory of process {pid} on a worker thread, passing each chunk read to {chunks}
+        Followed by None once finished, or the exception that stopped the read
+        The memory map is only parsed here, so it's as current as possible when the memory is read
+
+        :param pid: int of the process id
+        :param p_name: str of the process name
+        :param buffers: Queue of ctypes buffers shared between workers
+        :param chunks: Queue the archive writer reads the chunks from
+        :param cancel: Event set when the archive writer has stopped reading {chunks}, so the worker doesn't block forever
+        """
+        def put(item: Union[bytes, Exception, None]) -> bool:
+            while not cancel.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        maps = self.parse_mem_map(pid, p_name)
+        buff = buffers.get()
+        end: Union[Exception, None] = None
+        try:
+            for mem_page_content in self.read_regions(pid, maps, buff):
+                if not put(mem_page_content):
+                    return
+        except Exception as error:
+            end = error
+        finally:
+            buffers.put(buff)
+        put(end)
+
+    def get_chunk(self, chunks: "queue.Queue[Union[bytes, Exception, None]]", read_future: Future) -> Union[bytes, Exception, None]:
+        """Gets the next item queued by queue_regions, without blocking forever if its worker stopped early
+
+        :param chunks: Queue the worker passes chunks through
+        :param read_future: Future of the queue_regions call
+
+        :return: The next chunk, the exception that stopped the read, or None once finished
+        """
+        while True:
+            try:
+                return chunks.get(timeout=1)
+            except queue.Empty:
+                if read_future.done() and chunks.empty():
+                    # The worker exited without queueing its end, so something went wrong in it
+                    error = read_future.exception()
+                    return error if isinstance(error, Exception) else None
 
     def dump_processes(self) -> None:
-        """Dumps all processes to temp files, adds temp file to output archive then removes the temp file"""
+        """Dumps all processes, streaming each process's memory straight into the output archive
+        Processes are read in parallel by worker threads, while the archive is written by this thread alone
+        """
         archive_out = self.output_path
-        with zipfile.ZipFile(archive_out, "a", compression=zipfile.ZIP_DEFLATED) as zip_file:
-            for proc in tqdm(self.process_info, desc="Process dump progess", unit=" procs"):
-                pid = proc["Process ID"]
-                p_name = proc["Name"]
-                maps = self.parse_mem_map(pid, p_name)
-                if not maps:
-                    continue
-                with NamedTemporaryFile(mode="w+b", buffering=0, delete=True) as tmpfile:
+        buffers: "queue.Queue[ctypes.Array]" = queue.Queue()
+        buffers.put(self._read_buf)
+        for _ in range(_DUMP_WORKERS - 1):
+            buffers.put(ctypes.create_string_buffer(_READ_CHUNK_SIZE))
+        # Memory dumps barely compress, so store them rather than spending CPU on deflate
+        with ThreadPoolExecutor(max_workers=_DUMP_WORKERS) as executor, \
+                zipfile.ZipFile(archive_out, "a", compression=zipfile.ZIP_STORED) as zip_file:
+            dumps = []
+            try:
+                for proc in self.process_info:
+                    pid = proc["Process ID"]
+                    p_name = proc["Name"]
+                    # Kernel threads and zombies have no executable or memory to dump, and varc's own memory isn't needed
+                    if pid == os.getpid() or proc["Executable Path"] == "":
+                        continue
+                    # Only hold one chunk ahead per process, to bound memory use
+                    chunks: "queue.Queue[Union[bytes, Exception, None]]" = queue.Queue(maxsize=1)
+                    cancel = threading.Event()
+                    read_future = executor.submit(self.queue_regions, pid, p_name, buffers, chunks, cancel)
+                    dumps.append((pid, p_name, chunks, cancel, read_future))
+
+                # Written in the order submitted, which is the order the workers pick them up
+                for pid, p_name, chunks, cancel, read_future in tqdm(dumps, desc="Process dump progess", unit=" procs"):
                     try:
-                        for map in maps:
-                            page_start = map[0]
-                            page_len = map[1] - map[0]
-                            mem_page_content = self.read_bytes(pid, page_start, page_len)
-                            if mem_page_content:
-                                tmpfile.write(mem_page_content)
-                        zip_file.write(tmpfile.name, f"process_dumps{sep}{p_name}_{pid}.mem")
+                        # Wait for the first chunk before adding an entry, so processes that can't be read aren't listed
+                        mem_page_content = self.get_chunk(chunks, read_future)
+                        if isinstance(mem_page_content, Exception):
+                            raise mem_page_content
+                        if mem_page_content is None:
+                            logging.warning(f"No memory could be read for {p_name} (pid {pid}). Cannot dump this process.")
+                            continue
+                        with zip_file.open(f"process_dumps{sep}{p_name}_{pid}.mem", "w", force_zip64=True) as proc_dump:
+                            while mem_page_content is not None:
+                                if isinstance(mem_page_content, Exception):
+                                    raise mem_page_content
+                                proc_dump.write(mem_page_content)
+                                mem_page_content = self.get_chunk(chunks, read_future)
                     except PermissionError:
                         logging.warning(f"Permission denied opening process memory for {p_name} (pid {pid}). Cannot dump this process.")
                         continue
                     except OSError as oserror:
                         logging.warning(f"Error opening process memory page for {p_name} (pid {pid}). Error was {oserror}. Dump may be incomplete.")
                         pass
-                    
+                    finally:
+                        # Frees the worker if this dump was abandoned, e.g. the archive couldn't be written
+                        cancel.set()
+            finally:
+                for _, _, _, cancel, _ in dumps:
+                    cancel.set()
 
         logging.info(f"Dumping processing has completed. Output file is located: {archive_out}")
\ No newline at end of file
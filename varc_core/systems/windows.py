@@ -1,10 +1,8 @@
 import zipfile
-import tempfile
 from tqdm import tqdm
 import logging
 from typing import Tuple, Optional, Any
 from sys import platform
-from os import remove as del_file
 from os import sep
 from pathlib import Path
 from varc_core.systems.base_system import BaseSystem
@@ -84,12 +82,11 @@ class WindowsSystem(BaseSystem):
             
             # Dump all pages the process virtual address space
             next_region = 0
-            with zipfile.ZipFile(archive_out, 'a', compression=zipfile.ZIP_DEFLATED) as zip_file:
-                with tempfile.NamedTemporaryFile(mode="w+b", buffering=0, delete=False) as tmpfile:
+            # Memory dumps barely compress, so store them rather than spending CPU on deflate
+            with zipfile.ZipFile(archive_out, 'a', compression=zipfile.ZIP_STORED) as zip_file:
+                with zip_file.open(f"process_dumps{sep}{p_name}_{pid}.mem", "w", force_zip64=True) as proc_dump:
                     while next_region < user_space_limit:
                         proc_page_bytes, next_region = self.read_process(p.process_handle, next_region)
                         if proc_page_bytes:
-                            tmpfile.write(proc_page_bytes)
-                    zip_file.write(tmpfile.name, f"process_dumps{sep}{p_name}_{pid}.mem")
-                del_file(tmpfile.name)
+                            proc_dump.write(proc_page_bytes)
         logging.info(f"Dumping processing has completed. Output file is located: {archive_out}")